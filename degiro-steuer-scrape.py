@@ -1,144 +1,391 @@
-import pdfplumber
-import pandas as pd
+import numpy as np
+import xlsxwriter
 import re
 import os
 import logging
+import hashlib
+import tempfile
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from row_parser import parse_rows
+
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+except ImportError:
+    pdfium = None
+    import pdfplumber
+
+try:
+    import re2 as fast_re
+except ImportError:
+    fast_re = re
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Feste Anker der Tabellenabschnitte, werden per str.find gesucht
+DIVIDEND_START = "Land Bruttodividende Quellensteuer Nettodividende\n"
+DIVIDEND_END = "\nKuponübersicht"
+PROFITS_START = "Realisierte Gewinne/Verluste je Produkt"
+PROFITS_END = "Alle Dividenden und Kupons"
+
+# Explizite Zeichenklassen statt \s und \d: re2 kennt nur ASCII-\s/\d, re dagegen Unicode.
+# So liefern beide Backends dieselben Treffer; das geschützte Leerzeichen (\xa0) zählt als Leerraum.
+WS_CHARS = r" \t\n\r\f\v\xa0"
+TABLE_RE = fast_re.compile(
+    rf"([A-Za-z0-9{WS_CHARS}&\.\-]+)[{WS_CHARS}]+([A-Z0-9]+)[{WS_CHARS}]+([\-0-9,\.]+)[{WS_CHARS}]+([\-0-9,\.]+)"
+)
+GENERAL_RE = fast_re.compile(r'(.*?) ([0-9]+,[0-9]{2} EUR)')
+FEE_RE = re.compile(r"Transaktionsgebühren.*?([\d,.]+)\s*EUR")
+
+# Seiten pro Worker-Aufgabe beim parallelen Auslesen mit pdfplumber, amortisiert das erneute Öffnen der PDF
+PAGES_PER_TASK = 16
+
+# Format des gecachten Texts; bei jeder Änderung an Extraktion oder Normalisierung erhöhen
+CACHE_VERSION = 1
+
+# Ab dieser Zeilenzahl lohnt sich der numba-Kernel samt Import und Kompilierung
+NUMBA_MIN_ROWS = 10_000
+
+
+def _page_count(pdf_path):
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+def _normalize_pdfium_text(text):
+    """
+    Brings PDFium text closer to pdfplumber's layout output, which the anchors and parsers expect:
+    plain newlines, no trailing whitespace and single spaces between words.
+    """
+    # PDFium liefert \r\n, teils doppelte oder geschützte Leerzeichen und Leerraum am Zeilenende
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(" ".join(line.split()) for line in lines)
+
+
+def _extract_pages(pdf_path, page_range):
+    """
+    Extracts the text of the given pages. Opens the PDF itself so it can run in a worker process.
+    """
+    parts = []
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for i in page_range:
+                page = pdf[i]
+                # Reine Bildseiten (z.B. Scans) haben keine Textobjekte und werden übersprungen,
+                # bevor PDFium die Textseite aufbaut
+                if next(page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_TEXT]), None) is None:
+                    continue
+                page_text = _normalize_pdfium_text(page.get_textpage().get_text_range())
+                if page_text:
+                    parts.append(page_text)
+        finally:
+            pdf.close()
+    else:
+        with pdfplumber.open(pdf_path) as pdf:
+            for i in page_range:
+                page = pdf.pages[i]
+                # Die Objekte werden ohne Layoutanalyse gelesen und von extract_text wiederverwendet
+                if not page.objects.get("char"):
+                    continue
+                page_text = page.extract_text()
+                if page_text:
+                    parts.append(page_text)
+    return parts
+
+
+def _text_cache_dir():
+    """
+    Returns the per-user cache directory (XDG_CACHE_HOME or ~/.cache), created with owner-only permissions.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    cache_dir = os.path.join(base, "degiro-steuer-scrape")
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    return cache_dir
+
+
+def _text_cache_path(pdf_path):
+    """
+    Returns the cache file for the extracted text, keyed by path, size and modification time of the PDF,
+    by the extraction backend, since pypdfium2 and pdfplumber produce different text, and by CACHE_VERSION.
+    """
+    stat = os.stat(pdf_path)
+    backend = "pypdfium2" if pdfium is not None else "pdfplumber"
+    key = hashlib.blake2b(f"{CACHE_VERSION}:{backend}:{os.path.abspath(pdf_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return os.path.join(_text_cache_dir(), f"degiro-{key}.txt")
+
+
+def _write_text_cache(cache_path, text):
+    # Die Steuerübersicht enthält persönliche Daten: mkstemp legt die Datei mit 0600 an.
+    # Erst in eine temporäre Datei schreiben und dann umbenennen, damit nie ein halber Cache gelesen wird
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+    except (OSError, UnicodeError) as e:
+        logging.warning(f"Could not write text cache: {e}")
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
 def extract_text_from_pdf(pdf_path):
     """
     Extracts raw text from all pages of the PDF.
+    Uses pypdfium2 for plain text extraction and falls back to pdfplumber if it is not installed.
+    With pdfplumber, larger PDFs are split into chunks of PAGES_PER_TASK pages and extracted in parallel.
+    The result is cached in the per-user cache directory until the PDF changes.
     """
-    all_text = ""
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                all_text += page.extract_text() or ""
-        return all_text
+        try:
+            cache_path = _text_cache_path(pdf_path)
+        except OSError as e:
+            logging.warning(f"Text cache unavailable: {e}")
+            cache_path = None
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                with open(cache_path, encoding="utf-8") as f:
+                    text = f.read()
+                logging.info(f"Using cached text from {cache_path}")
+                return text
+            except (OSError, UnicodeDecodeError) as e:
+                # Unlesbarer Cache: PDF neu auslesen, der Cache wird danach überschrieben
+                logging.warning(f"Could not read text cache, extracting again: {e}")
+
+        n_pages = _page_count(pdf_path)
+        # PDFium ist nativer Code und braucht keinen Prozesspool; die Worker-Starts kosten dort mehr als sie sparen
+        if pdfium is not None or n_pages <= PAGES_PER_TASK:
+            text = "\n".join(_extract_pages(pdf_path, range(n_pages)))
+        else:
+            chunks = [range(start, min(start + PAGES_PER_TASK, n_pages)) for start in range(0, n_pages, PAGES_PER_TASK)]
+            # Jeder Worker importiert unter spawn das Skript neu, daher nicht mehr Prozesse als Aufgaben
+            max_workers = min(len(chunks), os.cpu_count() or 1)
+            try:
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    results = executor.map(partial(_extract_pages, pdf_path), chunks)
+                    text = "\n".join(part_text for part in results for part_text in part)
+            except (BrokenProcessPool, pickle.PicklingError) as e:
+                # Nur Poolfehler, z.B. nicht picklebares __main__._extract_pages (Notebook, runpy);
+                # echte PDF-Fehler gehen direkt an den äußeren Handler
+                logging.warning(f"Parallel extraction failed, extracting in-process: {e}")
+                text = "\n".join(_extract_pages(pdf_path, range(n_pages)))
+
+        if text and cache_path is not None:
+            _write_text_cache(cache_path, text)
+        return text
     except Exception as e:
         logging.error(f"Error reading PDF: {e}")
         return ""
 
 
-def extract_dividend_table(text):
+def _find_between(text, start_marker, end_marker):
     """
-    Extracts the dividend table from the raw PDF text.
-    Returns a DataFrame with dividend data.
+    Returns the text between the first start_marker and the following end_marker, or None.
     """
-    try:
-        pattern = re.compile(r"Land Bruttodividende Quellensteuer Nettodividende\n(.*?)\nKuponübersicht", re.S)
-        dividend_match = pattern.search(text)
-        
-        if not dividend_match:
-            logging.warning("Dividend table not found in text.")
-            return pd.DataFrame()
-        
-        table_text = dividend_match.group(1).strip()
-        divi_lines = table_text.split("\n")
-        divi_data = [re.split(r'\s+', line) for line in divi_lines[:-1]]
-        
-        dividend_df = pd.DataFrame(divi_data, columns=["Land", "Bruttodividende", "Quellensteuer", "Nettodividende"])
-        
-        # Clean and convert to float
-        for col in ["Bruttodividende", "Quellensteuer", "Nettodividende"]:
-            dividend_df[col] = dividend_df[col].str.replace(',', '.').astype(float)
-        
-        dividend_df["Steuersatz"] = dividend_df["Quellensteuer"] / dividend_df["Bruttodividende"]
+    start = text.find(start_marker)
+    if start == -1:
+        return None
+    start += len(start_marker)
+    end = text.find(end_marker, start)
+    if end == -1:
+        return None
+    return text[start:end]
 
-        dividend_sum = dividend_df["Bruttodividende"].sum()
-        dividend_sum_de = dividend_df.loc[dividend_df["Land"] == "DE", "Bruttodividende"].sum()
-        dividend_sum_ausl = dividend_df.loc[dividend_df["Land"] != "DE", "Bruttodividende"].sum()
 
+def find_sections(raw_text):
+    """
+    Locates the dividend table and the realized profits section by their literal anchors.
+    Returns (dividend_text, profits_text); a section that is not found is None.
+    """
+    return (
+        _find_between(raw_text, DIVIDEND_START, DIVIDEND_END),
+        _find_between(raw_text, PROFITS_START, PROFITS_END),
+    )
 
-        return dividend_df, dividend_sum, dividend_sum_de, dividend_sum_ausl
+
+def extract_dividend_table(table_text):
+    """
+    Extracts the dividend table from the section found by find_sections.
+    Returns the dividend rows (Land, Bruttodividende, Quellensteuer, Nettodividende, Steuersatz)
+    together with the gross sums (total, DE, foreign) and the withheld German capital gains tax.
+    Returns empty rows and zero sums only if the section is absent; a row that cannot be parsed raises.
+    """
+    try:
+        if table_text is None:
+            logging.warning("Dividend table not found in text.")
+            return [], 0.0, 0.0, 0.0, 0.0
+        
+        divi_lines = table_text.strip().split("\n")
+
+        # Einzelner Durchlauf über die wenigen Zeilen, Summen direkt als Skalare
+        divi_data = []
+        dividend_sum_de = 0.0
+        dividend_sum_ausl = 0.0
+        kapitalertragsteuer_de = 0.0
+        for line in divi_lines[:-1]:
+            land, brutto, quellensteuer, netto = line.split()
+            brutto = float(brutto.replace(',', '.'))
+            quellensteuer = float(quellensteuer.replace(',', '.'))
+            netto = float(netto.replace(',', '.'))
+            steuersatz = quellensteuer / brutto if brutto else float("nan")
+            divi_data.append((land, brutto, quellensteuer, netto, steuersatz))
+
+            if land == "DE":
+                dividend_sum_de += brutto
+                kapitalertragsteuer_de += quellensteuer
+            else:
+                dividend_sum_ausl += brutto
+
+        dividend_sum = dividend_sum_de + dividend_sum_ausl
+
+        return divi_data, dividend_sum, dividend_sum_de, dividend_sum_ausl, kapitalertragsteuer_de
 
     except Exception as e:
+        # Nicht mit Nullen weitermachen: eine scheinbar gültige Anlage KAP ohne Dividenden wäre schlimmer als ein Abbruch
         logging.error(f"Error extracting dividend table: {e}")
-        return pd.DataFrame()
+        raise
     
 
 
-def extract_realized_profits_and_fees(raw_text):
-    # Regex für den Abschnitt der realisierten Gewinne/Verluste
-    section_pattern = r"(Realisierte Gewinne/Verluste je Produkt)(.*?)(Alle Dividenden und Kupons)"
-    section_match = re.search(section_pattern, raw_text, re.DOTALL)
-    
-    if not section_match:
-        return None
-    
-    # Extrahierte Tabelle
-    section_text = section_match.group(2)
-    
-    # Regex für die eigentlichen Daten (Produkt, ISIN, Gewinne/Verluste, Gebühr)
-    table_pattern = r"([A-Za-z0-9\s&\.\-]+)\s+([A-Z0-9]+)\s+([\-0-9,\.]+)\s+([\-0-9,\.]+)"
-    
-    # Extrahieren der Tabellenzeilen
-    rows = re.findall(table_pattern, section_text)
-    
-    # Erstellen einer Liste von Dictionaries für jedes Produkt
-    data = []
-    for row in rows:
-        isin = row[1].strip()
-        data.append({
-            "Produkt": row[0].strip(),
-            "ISIN": isin,
-            "Realisierte Gewinne/Verluste": row[2].strip(),
-            "Transaktionsgebühr": row[3].strip(),
-            "Land": isin[:2]
-        })
-    numeric_cols = ["Realisierte Gewinne/Verluste", "Transaktionsgebühr"]
-    df = pd.DataFrame(data)
-    for col in numeric_cols:
-        df[col] = df[col].str.replace(',', '.').astype(float)
-    
-    df["G/V"] = df["Realisierte Gewinne/Verluste"] - df["Transaktionsgebühr"]
+def _aggregate_gv_loop(gv, is_de):
+    """
+    Sums gains and losses in a single loop, split into total, DE and foreign.
+    Returns (positive, negative, positive_de, negative_de, positive_ausl, negative_ausl).
+    """
+    pe = ne = ped = ned = pea = nea = 0.0
+    for i in range(gv.size):
+        v = gv[i]
+        if v > 0:
+            pe += v
+            if is_de[i]:
+                ped += v
+            else:
+                pea += v
+        elif v < 0:
+            ne += v
+            if is_de[i]:
+                ned += v
+            else:
+                nea += v
+    return pe, ne, ped, ned, pea, nea
+
+
+def _aggregate_gv_numpy(gv, is_de):
+    """
+    Numpy version of _aggregate_gv_loop, used for small tables and when numba is not installed.
+    """
+    # Masken nur einmal berechnen und für alle Summen wiederverwenden
+    pos = gv > 0
+    neg = gv < 0
 
-    positive_entries = df[df['G/V'] > 0]['G/V'].sum()
-    negative_entries = df[df['G/V'] < 0]['G/V'].sum()
+    ped = gv[pos & is_de].sum()
+    ned = gv[neg & is_de].sum()
+    pea = gv[pos & ~is_de].sum()
+    nea = gv[neg & ~is_de].sum()
+    return ped + pea, ned + nea, ped, ned, pea, nea
 
-    positive_entries_de = df[(df['G/V'] > 0) & (df["Land"] == "DE")]['G/V'].sum()
 
-    negative_entries_de = df[(df['G/V'] < 0) & (df["Land"] == "DE")]['G/V'].sum()
+_aggregate_gv_jit = None
 
-    positive_entries_ausl = df[(df['G/V'] > 0) & (df["Land"] != "DE")]['G/V'].sum()
-    negative_entries_ausl = df[(df['G/V'] < 0) & (df["Land"] != "DE")]['G/V'].sum()
 
+def _aggregate_gv(gv, is_de):
+    """
+    Dispatches to the numba kernel for large tables and to numpy otherwise.
+    numba is only imported on first use; its import and JIT cost do not pay off for a few dozen rows.
+    """
+    global _aggregate_gv_jit
+    if gv.size < NUMBA_MIN_ROWS:
+        return _aggregate_gv_numpy(gv, is_de)
+    if _aggregate_gv_jit is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _aggregate_gv_jit = _aggregate_gv_numpy
+        else:
+            _aggregate_gv_jit = njit(cache=True)(_aggregate_gv_loop)
+    return _aggregate_gv_jit(gv, is_de)
+
+
+def extract_realized_profits_and_fees(section_text):
+    # Abschnitt der realisierten Gewinne/Verluste, siehe find_sections
+    if section_text is None:
+        # Leere Spalten und Nullsummen, damit main trotzdem auswerten kann
+        logging.warning("Realized profits section not found in text.")
+        rows = []
+    else:
+        # Extrahieren der Tabellenzeilen (Produkt, ISIN, Gewinne/Verluste, Gebühr)
+        rows = TABLE_RE.findall(section_text)
+    
+    # Spaltenweise zerlegen (mit mypyc kompilierbar, siehe row_parser.py)
+    produkt, isin, realized, fee, land = parse_rows(rows)
 
-    return df, positive_entries, negative_entries, positive_entries_de, negative_entries_de, positive_entries_ausl, negative_entries_ausl
+    realized = np.asarray(realized, dtype=np.float64)
+    fee = np.asarray(fee, dtype=np.float64)
+    gv = realized - fee
+    # Spalten als dict, kann bei Bedarf direkt an pd.DataFrame übergeben werden
+    columns = {
+        "Produkt": produkt,
+        "ISIN": isin,
+        "Realisierte Gewinne/Verluste": realized,
+        "Transaktionsgebühr": fee,
+        "Land": land,
+        "G/V": gv,
+    }
+
+    is_de = np.array([country == "DE" for country in land], dtype=np.bool_)
+    positive_entries, negative_entries, positive_entries_de, negative_entries_de, positive_entries_ausl, negative_entries_ausl = _aggregate_gv(gv, is_de)
+
+    return columns, positive_entries, negative_entries, positive_entries_de, negative_entries_de, positive_entries_ausl, negative_entries_ausl
 
 
 def extract_general_data(text):
     """
     Extracts general key-value pairs (like Ausschüttungen) from the PDF text.
     """
-    data = []
     try:
-        lines = text.split('\n')
-        for line in lines:
-            matches = re.findall(r'(.*?) (\d+,\d{2} EUR)', line)
-            if matches:
-                for description, value in matches:
-                    data.append([description.strip(), value.strip()])
-        return data
+        # Das Muster kann keine Zeilenumbrüche überspannen, daher reicht ein Durchlauf über den gesamten Text
+        return [[description.strip(), value.strip()] for description, value in GENERAL_RE.findall(text)]
     except Exception as e:
         logging.error(f"Error extracting general data: {e}")
         return []
 
 
-def save_to_excel(data, output_path):
+def save_to_excel(rows, output_path):
+    """
+    Writes the tax rows (dicts with Zeile, Beschreibung, Betrag_num) to an Excel sheet,
+    including a formatted Betrag column.
+    """
     try:
-        data.to_excel(output_path, index=False)
+        # xlsxwriter schreibt die Zeilen direkt als XML statt das ganze Workbook im Speicher zu halten
+        workbook = xlsxwriter.Workbook(output_path, {"constant_memory": True})
+        try:
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, ["Zeile", "Beschreibung", "Betrag_num", "Betrag"])
+            for i, row in enumerate(rows, start=1):
+                worksheet.write_row(i, 0, [row["Zeile"], row["Beschreibung"], row["Betrag_num"], f"{row['Betrag_num']:.2f} EUR"])
+        finally:
+            workbook.close()
         logging.info(f"Data successfully saved to {output_path}")
     except Exception as e:
         logging.error(f"Failed to save Excel file: {e}")
 
-        import re
-
-import re
 
 def extract_transaction_fee(raw_text):
-    match = re.search(r"Transaktionsgebühren.*?([\d,.]+)\s*EUR", raw_text)
+    match = FEE_RE.search(raw_text)
     
     if match:
         # Komma durch Punkt ersetzen und in float umwandeln
@@ -151,8 +398,6 @@ def extract_transaction_fee(raw_text):
 
 def main(pdf_path, output_path):
     raw_text = extract_text_from_pdf(pdf_path)
-
-    anlage_kap = pd.DataFrame()
     
     if not raw_text:
         logging.error("No text extracted from PDF.")
@@ -160,8 +405,9 @@ def main(pdf_path, output_path):
     
     transaktionsgebuehren = extract_transaction_fee(raw_text)
     
-    dividend_df, dividend_sum, dividend_sum_de, dividend_sum_ausl = extract_dividend_table(raw_text)
-    profits_df, positive_entries, negative_entries, positive_entries_de, negative_entries_de, positive_entries_ausl, negative_entries_ausl = extract_realized_profits_and_fees(raw_text)
+    dividend_text, profits_text = find_sections(raw_text)
+    dividend_rows, dividend_sum, dividend_sum_de, dividend_sum_ausl, kapitalertragsteuer_divi = extract_dividend_table(dividend_text)
+    profits_columns, positive_entries, negative_entries, positive_entries_de, negative_entries_de, positive_entries_ausl, negative_entries_ausl = extract_realized_profits_and_fees(profits_text)
 
     kapitalertraege = dividend_sum_de + positive_entries_de
 
@@ -170,7 +416,6 @@ def main(pdf_path, output_path):
     kapitalertraege_de = positive_entries_de + negative_entries_de + dividend_sum_de
 
 
-    kapitalertragsteuer_divi = dividend_df.loc[dividend_df["Land"] == "DE"]["Quellensteuer"].sum()
     soli_divi = kapitalertragsteuer_divi * 0.055
     anrechenb_ausl_steuer = dividend_sum_ausl * 0.15
 
@@ -189,10 +434,7 @@ def main(pdf_path, output_path):
             {"Zeile": "41", "Beschreibung": "Anrechenbare ausländische Steuern", "Betrag_num": anrechenb_ausl_steuer}
         ]
     
-    anlage_kap = pd.DataFrame(tax_rows)
-    anlage_kap["Betrag"] = anlage_kap["Betrag_num"].apply(lambda x: f"{x:.2f} EUR")
-
-    save_to_excel(anlage_kap, output_path)
+    save_to_excel(tax_rows, output_path)
 
 
 
@@ -0,0 +1,29 @@
+"""
+Row tokenizer for the realized profits table.
+
+The module is fully type-annotated so it can be compiled with mypyc
+(`pip install mypy && mypyc row_parser.py`, run in this directory). The
+compiled extension is picked up automatically on import; without it the
+plain Python module is used.
+"""
+from typing import List, Tuple
+
+
+def parse_rows(rows: List[Tuple[str, str, str, str]]) -> Tuple[List[str], List[str], List[float], List[float], List[str]]:
+    """
+    Splits the TABLE_RE matches into column lists (Produkt, ISIN, Gewinne/Verluste, Gebühr, Land).
+    Amounts use a decimal comma and are converted to float.
+    """
+    produkt: List[str] = []
+    isin: List[str] = []
+    realized: List[float] = []
+    fee: List[float] = []
+    land: List[str] = []
+    for produkt_s, isin_s, realized_s, fee_s in rows:
+        isin_s = isin_s.strip()
+        produkt.append(produkt_s.strip())
+        isin.append(isin_s)
+        realized.append(float(realized_s.strip().replace(',', '.')))
+        fee.append(float(fee_s.strip().replace(',', '.')))
+        land.append(isin_s[:2])
+    return produkt, isin, realized, fee, land